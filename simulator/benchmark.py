@@ -0,0 +1,47 @@
+import sys
+import timeit
+from pathlib import Path
+from random import random
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from src.led_effect import COLORS, numpy, numpyCompositor, pythonCompositor
+
+# Per-frame time of the compositor backends, when two overlapping effects
+# update all LEDs of a chain on every frame.
+
+class mockLedHelper:
+    def __init__(self, led_count):
+        self.led_count = led_count
+        self.led_state = [(0.0, 0.0, 0.0, 0.0)] * led_count
+
+class mockChain:
+    def __init__(self, led_count):
+        self.led_helper = mockLedHelper(led_count)
+
+class mockEffect:
+    def __init__(self, chain, indices, useNumpy):
+        self.leds = [(chain, i) for i in indices]
+        self.ledCount = len(self.leds)
+        self.frame = [random() for _ in range(COLORS * self.ledCount)]
+        if useNumpy:
+            self.frame = numpy.array(self.frame)
+        self.fadeValue = 0.8
+
+def benchmark(compositor, led_count, frames=20):
+    chain = mockChain(led_count)
+    useNumpy = isinstance(compositor, numpyCompositor)
+    effects = [mockEffect(chain, range(led_count), useNumpy),
+               mockEffect(chain, range(led_count // 2, led_count), useNumpy)]
+    compositor.mapLeds(effects)
+    dirtyLeds = {chain: set(range(led_count))}
+    return timeit.timeit(lambda: compositor.compose(dirtyLeds),
+                         number=frames) / frames
+
+if __name__ == '__main__':
+    backends = [('python', pythonCompositor)]
+    if numpy is not None:
+        backends.append(('numpy', numpyCompositor))
+    for led_count in (100, 1000, 5000):
+        for name, backend in backends:
+            print("%5d LEDs  %-7s %8.3f ms/frame"
+                  % (led_count, name, 1000 * benchmark(backend(), led_count)))
@@ -7,10 +7,12 @@ parent, root = file.parent, file.parents[2]
 print(root)
 sys.path.append(str(root))
 from pathlib import Path
+import time
 from src.led_effect import ledEffect, ledFrameHandler
 
 class mockPrinter:
     NOW = 0
+    NEVER = 9999999999999999.
     def __init__(self, config):
         self.config = config
         self.config.set_printer(self)
@@ -54,6 +56,10 @@ class mockPrinter:
         pass
     def get_reactor(self):
         return self
+    def update_timer(self, timer, time):
+        pass
+    def monotonic(self):
+        return time.monotonic()
     def register_timer(self, callback, time):
         pass
     def get_temp(self, time):
@@ -110,20 +116,25 @@ class mockConfig:
         return self.printer
     def get_object(self,o):
         return self
-    def getfloat(self,key,default,minval,maxval):
-        return float(self.config[key])
+    def getfloat(self,key,default,minval=None,maxval=None,above=None,
+                 below=None):
+        return float(self.config.get(key, default))
     def getboolean(self,key,default):
-        return bool(self.config[key])
-    def getint(self,key,default,minval,maxval):
-        return int(self.config[key])
+        return bool(self.config.get(key, default))
+    def getint(self,key,default,minval=None,maxval=None):
+        return int(self.config.get(key, default))
+    def getchoice(self,key,choices,default):
+        return choices[self.config.get(key, default)]
     def setint(self,key, value):
         self.config[key] = int (value)
     def getlist(self,key,default):
         return list(self.config[key])
     def get_name(self):
         return "led_effect simulator"
-    def get(self, key, default=None ):
-        return self.config[key]
+    def get(self, key, default=KeyError ):
+        if default is KeyError:
+            return self.config[key]
+        return self.config.get(key, default)
     def set(self, key, value ):
         self.config[key]=value
 
@@ -6,8 +6,27 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
-from math import cos, exp, pi
+from array import array
+from bisect import bisect
+from collections import OrderedDict
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, wait
+import functools
+import hashlib
+from heapq import heappop, heappush
+import itertools
+import logging
+from math import cos, exp, gcd, pi
+import mmap
+import multiprocessing
+import os
 from random import randint
+from time import perf_counter
+import weakref
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 ANALOG_SAMPLE_TIME  = 0.001
 ANALOG_SAMPLE_COUNT = 5
@@ -15,46 +34,748 @@ ANALOG_REPORT_TIME  = 0.05
 
 COLORS = 4
 
+STATS_BUCKETS = (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05)
+
+ADAPTIVE_INTERVAL  = 1.0
+ADAPTIVE_SMOOTHING = 0.1
+ADAPTIVE_LATE      = 0.02
+ADAPTIVE_ON_TIME   = 0.005
+
+TRANSMIT_BURST_TIME   = 0.1
+TRANSMIT_CHUNK_SIZE   = 16
+TRANSMIT_CHUNK_HEADER = 6
+
+BAKE_MAX_SIZE = 4194304
+LINE_CACHE_SIZE = 64
+LUT_CACHE_SIZE  = 256
+
 ######################################################################
 # Custom color value list, returns lists of [r, g ,b] values
-# from a one dimensional list
+# from a one dimensional list. Values are stored as a compact float
+# array, indexing and slicing return views into that array. The array
+# is used as a ring buffer, so shifting only moves the start offset.
 ######################################################################
 
-class colorArray(list):
+class colorArray(object):
     def __init__(self, num_colors, kwargs):
         self.n=num_colors
-        super(colorArray,self).__init__(kwargs)
-        
+        self._assign(self._concat(kwargs))
+
+    @classmethod
+    def _view(cls, num_colors, data):
+        view = cls.__new__(cls)
+        view.n = num_colors
+        view.data = data
+        view.offset = 0
+        return view
+
+    def _assign(self, other):
+        self.data = other.data
+        self.offset = 0
+
+    def _segments(self):
+        if not self.offset:
+            return (self.data,)
+        o = self.offset * self.n
+        return (self.data[o:], self.data[:o])
+
+    def _concat(self, *parts):
+        values = array('f')
+        for part in parts:
+            segments = part._segments() if isinstance(part, colorArray) \
+                        else (part,)
+            for segment in segments:
+                if isinstance(segment, memoryview):
+                    values.frombytes(segment.cast('B'))
+                else:
+                    values.extend(segment)
+        return colorArray._view(self.n, memoryview(values))
+
     def __getitem__(self, a):
         if isinstance(a, int):
-            return super(colorArray, self).__getitem__(
-                            slice(a*self.n, a*self.n+self.n))
+            if a < 0:
+                a += len(self)
+            if self.offset:
+                a = (a + self.offset) % len(self)
+            return self.data[a*self.n:a*self.n+self.n]
         if isinstance(a, slice):
-                start = a.start*self.n if a.start != None else None
-                stop = a.stop*self.n if a.stop != None else None
-                return colorArray(self.n,
-                        super(colorArray, self).__getitem__(
-                            slice(start, stop, a.step)))
+            start, stop, step = a.indices(len(self))
+            if step != 1:
+                return self._concat(*[self[i] for i
+                                        in range(start, stop, step)])
+            count = max(0, stop - start)
+            if count and self.offset:
+                start = (start + self.offset) % len(self)
+                if start + count > len(self):
+                    wrap = start + count - len(self)
+                    return self._concat(self.data[start*self.n:],
+                                        self.data[:wrap*self.n])
+            return colorArray._view(self.n,
+                        self.data[start*self.n:(start+count)*self.n])
     def __getslice__(self, a, b):
         return self.__getitem__(slice(a,b))
     def __setitem__(self, a, v):
         if isinstance(a, int):
+            led = self[a]
             for i in range(self.n):
-                super(colorArray, self).__setitem__(a*self.n + i, v[i])
+                led[i] = float(v[i])
     def __len__(self):
-        return super(colorArray, self).__len__() // self.n
+        return len(self.data) // self.n
+    def __iter__(self):
+        return itertools.chain(*self._segments())
+    def __add__(self, other):
+        return self._concat(self, other)
+    def __radd__(self, other):
+        return self._concat(other, self)
+    def __iadd__(self, other):
+        self._assign(self._concat(self, other))
+        return self
+    def __mul__(self, count):
+        return colorArray._view(self.n,
+                    memoryview(self._concat(self).data.obj * count))
+    __rmul__ = __mul__
     def reverse(self):
-        self.__init__(self.n, [c for cl in range(len(self)-1,-1, -1)
-                        for c in self[cl]])
+        self._assign(self._concat(*[self[cl] for cl in
+                                    range(len(self)-1, -1, -1)]))
     def shift(self, shift=1, direction=True):
         if direction:
             shift *= -1
-        self.__init__(self.n, self[shift:] + self[:shift])
+        if abs(shift) < len(self):
+            self.offset = (self.offset + shift) % len(self)
     def padLeft(self, v, a):
-        self.__init__(self.n, v * a + self)
+        self._assign(self._concat(v * a, self))
     def padRight(self, v, a):
         self += v * a
 
+######################################################################
+# Frame of LEDs in a single color. Only the color is stored, it's
+# repeated for each LED when the frame is blended
+######################################################################
+
+class solidFrame(object):
+    def __init__(self, color, count):
+        self.color = color
+        self.count = count
+
+    def __len__(self):
+        return COLORS * self.count
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(itertools.repeat(self.color,
+                                                              self.count))
+
+# Frame table of solid frames, it only holds a color per frame. It's
+# neither precomputed nor stored on disk
+class colorTable(list):
+    pass
+
+######################################################################
+# Frame cache, keeps the most recently used frames of the layers that
+# render their frames on first use, up to a size in bytes
+######################################################################
+
+class frameCache(object):
+    def __init__(self, size):
+        self.size   = size
+        self.used   = 0
+        self.frames = OrderedDict()
+
+    def get(self, key, render):
+        frame = self.frames.get(key)
+        if frame is not None:
+            self.frames.move_to_end(key)
+            return frame
+        frame = render()
+        self.frames[key] = frame
+        self.used += frame.data.nbytes
+        while self.used > self.size and len(self.frames) > 1:
+            _, old = self.frames.popitem(last=False)
+            self.used -= old.data.nbytes
+        return frame
+
+class lazyFrames(object):
+    def __init__(self, cache, count, render, key=None):
+        self.cache  = cache
+        self.count  = count
+        self.render = render
+        self.key    = self if key is None else key
+
+    def __len__(self):
+        return self.count
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("frame index out of range")
+        if self.cache is None:
+            return self.render(i)
+        return self.cache.get((self.key, i), lambda: self.render(i))
+
+class frameTable(list):
+    pass
+
+######################################################################
+# Table cache, layers with the same parameters share their frame tables.
+# Tables are dropped with the last layer using them
+######################################################################
+
+class tableCache(object):
+    def __init__(self):
+        self.tables = weakref.WeakValueDictionary()
+        self.hits   = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        table = self.tables.get(key)
+        if table is not None:
+            self.hits += 1
+            return table
+        self.misses += 1
+        table = build()
+        self.tables[key] = table
+        return table
+
+    def get_status(self):
+        return {'tables': len(self.tables),
+                'hits'  : self.hits,
+                'misses': self.misses}
+
+    def summary(self):
+        return "%d shared, %d hits, %d misses" % (
+            len(self.tables), self.hits, self.misses)
+
+######################################################################
+# Disk cache, stores the frame tables of the configured layers as float32
+# files. The files are mapped into memory when loaded, so they are shared
+# and paged by the OS. The least recently used files are removed beyond
+# the size limit
+######################################################################
+
+class diskCache(object):
+    def __init__(self, path, size):
+        self.path   = os.path.expanduser(path)
+        self.size   = size
+        self.loaded = 0
+        self.stored = 0
+        # tables are only valid for the code that computed them
+        with open(__file__, 'rb') as f:
+            self.version = hashlib.sha1(f.read()).hexdigest()[:12]
+        self._removeFiles(lambda name: not name.startswith(self.version))
+
+    def _fileName(self, key):
+        digest = hashlib.sha1((self.version + repr(key)).encode())
+        return os.path.join(self.path,
+                            "%s-%s.f32" % (self.version, digest.hexdigest()))
+
+    # cache files with their size, the least recently used first
+    def _files(self):
+        try:
+            names = [name for name in os.listdir(self.path)
+                     if name.endswith('.f32') or name.endswith('.tmp')]
+        except OSError:
+            return []
+        files = []
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+        return sorted(files)
+
+    def _removeFiles(self, remove):
+        for _, _, name in self._files():
+            if remove(name):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+    # remove the least recently used tables, until the files fit in size
+    def _limitSize(self):
+        files = self._files()
+        used = sum(size for _, size, _ in files)
+        for _, size, name in files:
+            if used <= self.size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                continue
+            used -= size
+
+    def _load(self, fileName, count, size):
+        try:
+            with open(fileName, 'rb') as f:
+                if os.fstat(f.fileno()).st_size != count * size * 4:
+                    return None
+                #the map stays valid when the file is closed
+                data = memoryview(mmap.mmap(f.fileno(), 0,
+                                            access=mmap.ACCESS_READ))
+            os.utime(fileName)
+        except (OSError, ValueError):
+            return None
+        return tableView(data, count, size)
+
+    def _store(self, fileName, table):
+        values = colorArray(COLORS, [])._concat(*table).data
+        tempName = "%s.%d.tmp" % (fileName, os.getpid())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tempName, 'wb') as f:
+                f.write(values)
+            os.replace(tempName, fileName)
+        except OSError as e:
+            logging.warning("led_effect: can't store frame table in '%s': %s",
+                            self.path, e)
+            return False
+        self._limitSize()
+        return True
+
+    def get(self, key, count, size, build):
+        fileName = self._fileName(key)
+        frames = self._load(fileName, count, size) if count else None
+        if frames is not None:
+            self.loaded += 1
+            return frames
+        table = build()
+        if not count or sum(len(frame) * (COLORS if isinstance(frame,
+                colorArray) else 1) for frame in table) != count * size:
+            return table
+        if self._store(fileName, table):
+            self.stored += 1
+            frames = self._load(fileName, count, size)
+        return table if frames is None else frames
+
+    def summary(self):
+        return "%d loaded, %d stored" % (self.loaded, self.stored)
+
+######################################################################
+# Precomputation, frame tables of all effects are computed on startup by
+# a pool of worker processes and returned as float32 buffers
+######################################################################
+
+class precomputeContext(object):
+    # stands in for the effect and the frame handler of a layer created
+    # in a worker process
+    analytic  = False
+    diskCache = None
+    heater    = ''
+    stepper   = ''
+    name      = ''
+
+    def __init__(self):
+        self.frameCache      = frameCache(0)
+        self.tableCache      = tableCache()
+        self.endstops        = []
+        self.homing_end_flag = {}
+
+def precomputeTable(job):
+    # runs in a worker process, returns frame count and values of the
+    # layer's frame table, None if the layer has no precomputed table
+    name, kwargs = job
+    context = precomputeContext()
+    try:
+        layer = getattr(ledEffect, name)(handler=context, frameHandler=context,
+                                         **kwargs)
+    except Exception:
+        return None
+    table = layer.thisFrame
+    if not isinstance(table, frameTable):
+        return None
+    values = colorArray(COLORS, [])._concat(*table).data
+    if len(values) != len(table) * COLORS * layer.ledCount:
+        return None
+    return len(table), values.tobytes()
+
+def tableView(data, count, size):
+    data = memoryview(data).cast('f')
+    return frameTable(colorArray._view(COLORS, data[i*size:(i+1)*size])
+                      for i in range(count))
+
+######################################################################
+# Lookup tables, gradients and decay tables are computed once for each
+# set of parameters and shared by all layers, so they are read only
+######################################################################
+
+@functools.lru_cache(maxsize=LUT_CACHE_SIZE)
+def gradientTable(palette, steps, reverse, toFirst):
+    palette = colorArray(COLORS, list(palette))
+    if reverse: palette.reverse()
+
+    if len(palette) < 2:
+        return readOnly(palette * steps)
+
+    if toFirst:
+        palette += palette[0]
+
+    paletteIntervals = len(palette)-1
+    stepIntervals = steps if toFirst else steps-1
+    if stepIntervals != 0:
+        intervals_per_step = float(paletteIntervals) / stepIntervals
+    else:
+        intervals_per_step = 0
+
+    if numpy is not None:
+        colors = numpy.array(palette.data, numpy.float64).reshape(-1, COLORS)
+        j = intervals_per_step * numpy.arange(1, steps)
+        k = j.astype(int)
+        r = (j - k)[:, None]
+        k = numpy.minimum(k, paletteIntervals)
+        z = (1-r)*colors[k] + r*colors[numpy.minimum(k+1, paletteIntervals)]
+        z = numpy.where((k[:, None]+1 >= len(palette)) | (r == 0.0),
+                        colors[k], z)
+        gradient = colors[0].astype(numpy.float32).tobytes() + \
+                   z.astype(numpy.float32).tobytes()
+        return colorArray._view(COLORS, memoryview(gradient).cast('f'))
+
+    gradient=list(palette[0])
+
+    for i in range(1,steps):
+        j = intervals_per_step * i
+        k = int(j) 
+        r = j-k
+        k = min(k, len(palette)-1)
+
+        if ( (k+1) >= len(palette) ) | (r == 0.0) :
+            gradient.extend(palette[k])
+        else:
+            gradient.extend([((1-r)*palette[k][m] + r*palette[k+1][m])
+                             for m in range(COLORS)])
+    return readOnly(colorArray(COLORS, gradient))
+
+@functools.lru_cache(maxsize=LUT_CACHE_SIZE)
+def decayTable(frameRate, factor, rate):
+    frame = []
+
+    p = (1.0 / frameRate)
+    r = (p/15.0)*factor
+
+    for s in range(0, int((rate<1)+rate)):
+        frame.append(1.0)
+        for x in range(2, int(p / rate)):
+            b = exp(1)**-(x/r)
+            if b>.004:
+                frame.append(b)
+    return tuple(frame)
+
+# colors backed by an immutable bytes buffer
+def readOnly(colors):
+    values = colorArray(COLORS, colors).data.tobytes()
+    return colorArray._view(COLORS, memoryview(values).cast('f'))
+
+def frameToArray(frame, out):
+    # copy a layer frame into the float64 numpy array out, for blending
+    if isinstance(frame, solidFrame):
+        out.reshape(-1, COLORS)[:] = frame.color
+    elif isinstance(frame, colorArray):
+        pos = 0
+        for segment in frame._segments():
+            values = numpy.frombuffer(segment, numpy.float32)[:len(out)-pos]
+            out[pos:pos+len(values)] = values
+            pos += len(values)
+    else:
+        out[:] = frame
+    return out
+
+def numpyOverlay(t, b, m):
+    # t > 0.5: 2*t*b, else: 1 - 2*(1-t)*(1-b). Result in b
+    numpy.less_equal(t, 0.5, out=m)
+    numpy.subtract(1.0, t, out=t, where=m)
+    numpy.subtract(1.0, b, out=b, where=m)
+    numpy.multiply(numpy.multiply(t, b, out=b), 2.0, out=b)
+    numpy.subtract(1.0, b, out=b, where=m)
+
+# Python blending, the colors of the top frame are blended into the bottom
+# frame in place
+def pythonTop(top, bottom):
+    bottom[:] = top
+
+def pythonAdd(top, bottom):
+    for i, t in enumerate(top):
+        b = bottom[i]
+        bottom[i] = t + b
+
+def pythonSubtract(top, bottom):
+    for i, t in enumerate(top):
+        b = bottom[i]
+        bottom[i] = (b - t) * (b - t > 0)
+
+def pythonSubtractB(top, bottom):
+    for i, t in enumerate(top):
+        b = bottom[i]
+        bottom[i] = (t - b) * (t - b > 0)
+
+def pythonDifference(top, bottom):
+    for i, t in enumerate(top):
+        b = bottom[i]
+        bottom[i] = (t - b) * (t > b) + (b - t) * (t <= b)
+
+def pythonAverage(top, bottom):
+    for i, t in enumerate(top):
+        b = bottom[i]
+        bottom[i] = 0.5 * (t + b)
+
+def pythonMultiply(top, bottom):
+    for i, t in enumerate(top):
+        b = bottom[i]
+        bottom[i] = t * b
+
+def pythonDivide(top, bottom):
+    for i, t in enumerate(top):
+        b = bottom[i]
+        bottom[i] = t / b if b > 0 else 0
+
+def pythonDivideInv(top, bottom):
+    for i, t in enumerate(top):
+        b = bottom[i]
+        bottom[i] = b / t if t > 0 else 0
+
+def pythonScreen(top, bottom):
+    for i, t in enumerate(top):
+        b = bottom[i]
+        bottom[i] = 1.0 - (1.0-t)*(1.0-b)
+
+def pythonLighten(top, bottom):
+    for i, t in enumerate(top):
+        b = bottom[i]
+        bottom[i] = t * (t > b) + b * (t <= b)
+
+def pythonDarken(top, bottom):
+    for i, t in enumerate(top):
+        b = bottom[i]
+        bottom[i] = t * (t < b) + b * (t >= b)
+
+def pythonOverlay(top, bottom):
+    for i, t in enumerate(top):
+        b = bottom[i]
+        bottom[i] = 2.0 * t * b if t > 0.5 else \
+                    1.0 - (2.0 * (1.0-t) * (1.0-b))
+
+######################################################################
+# Compositors, sum up the frames of all effects into the LED states
+# of the chains
+######################################################################
+
+class pythonCompositor(object):
+    def __init__(self):
+        self.ledOwners = {}
+
+    def mapLeds(self, effects):
+        #map each LED to the effects and frame positions driving it
+        self.ledOwners = {}
+        for effect in effects:
+            for i, led in enumerate(effect.leds):
+                self.ledOwners.setdefault(led, []).append((effect, i))
+
+    def compose(self, dirtyLeds):
+        #the colors are summed up in local floats, no lists per LED
+        clamp = (lambda x : 0.0 if x < 0.0 else 1.0 if x > 1.0 else x)
+        changedChains = set()
+        for chain, indices in dirtyLeds.items():
+            led_state = chain.led_helper.led_state
+            for index in indices:
+                red = green = blue = white = 0.0
+                for effect, i in self.ledOwners[(chain, index)]:
+                    frame = effect.frame
+                    fade  = clamp(effect.fadeValue)
+                    i    *= COLORS
+                    red   = min(1.0, red   + clamp(frame[i]   * fade))
+                    green = min(1.0, green + clamp(frame[i+1] * fade))
+                    blue  = min(1.0, blue  + clamp(frame[i+2] * fade))
+                    white = min(1.0, white + clamp(frame[i+3] * fade))
+
+                next_state = (red, green, blue, white)
+                if led_state[index] != next_state:
+                    led_state[index] = next_state
+                    changedChains.add(chain)
+        return changedChains
+
+class numpyCompositor(object):
+    def __init__(self):
+        self.accumulators = {}
+        self.chainEffects = {}
+        self.frames       = {}
+        self.states       = {}
+
+    def mapLeds(self, effects):
+        #per chain: the effects on it with their frame and chain positions.
+        #All arrays used while composing are allocated here, once
+        self.accumulators = {}
+        self.chainEffects = {}
+        self.frames       = {}
+        self.states       = {}
+        for effect in effects:
+            self.frames[effect] = numpy.zeros((effect.ledCount, COLORS),
+                                              numpy.float32)
+            positions = {}
+            for i, (chain, index) in enumerate(effect.leds):
+                positions.setdefault(chain, ([], []))
+                positions[chain][0].append(i)
+                positions[chain][1].append(index)
+            for chain, (frameIdx, chainIdx) in positions.items():
+                if chain not in self.accumulators:
+                    ledCount = chain.led_helper.led_count
+                    self.accumulators[chain] = numpy.zeros(
+                        (ledCount, COLORS), numpy.float32)
+                    #the colors last written to led_state, the list they
+                    #were written to and scratch space to compare them
+                    self.states[chain] = [
+                        numpy.zeros((ledCount, COLORS), numpy.float32), None,
+                        numpy.zeros((ledCount, COLORS), bool),
+                        numpy.zeros(ledCount, bool)]
+                    self.chainEffects[chain] = []
+                self.chainEffects[chain].append(
+                    (effect, numpy.array(frameIdx), numpy.array(chainIdx),
+                     len(set(chainIdx)) == len(chainIdx),
+                     numpy.zeros((len(frameIdx), COLORS), numpy.float32),
+                     numpy.zeros((len(frameIdx), COLORS), numpy.float32)))
+
+    def compose(self, dirtyLeds):
+        scaled = set()
+        changedChains = set()
+        for chain, indices in dirtyLeds.items():
+            acc = self.accumulators[chain]
+            acc.fill(0.0)
+            for effect, frameIdx, chainIdx, unique, colors, sums in \
+                    self.chainEffects[chain]:
+                frame = self.frames[effect]
+                if effect not in scaled:
+                    scaled.add(effect)
+                    fade = min(1.0, max(0.0, effect.fadeValue))
+                    numpy.copyto(frame, effect.frame.reshape(-1, COLORS),
+                                 casting='same_kind')
+                    numpy.clip(numpy.multiply(frame, fade, out=frame),
+                               0.0, 1.0, out=frame)
+                numpy.take(frame, frameIdx, axis=0, out=colors)
+                if unique:
+                    numpy.take(acc, chainIdx, axis=0, out=sums)
+                    acc[chainIdx] = numpy.add(sums, colors, out=sums)
+                else:
+                    numpy.add.at(acc, chainIdx, colors)
+            numpy.minimum(acc, 1.0, out=acc)
+
+            #only colors that changed since they were last written are
+            #converted to tuples, unless led_state was replaced meanwhile
+            led_state = chain.led_helper.led_state
+            state = self.states[chain]
+            last, written, changed, changedLeds = state
+            if led_state is not written:
+                last.fill(numpy.nan)
+            numpy.any(numpy.not_equal(acc, last, out=changed), axis=1,
+                      out=changedLeds)
+            for index in indices:
+                if not changedLeds[index]:
+                    continue
+                last[index] = acc[index]
+                next_state = tuple(acc[index].tolist())
+                if led_state[index] != next_state:
+                    led_state[index] = next_state
+                    changedChains.add(chain)
+            state[1] = led_state
+        return changedChains
+
+######################################################################
+# Transmit scheduler, limits the LED data sent to each MCU
+######################################################################
+
+class transmitScheduler(object):
+    def __init__(self, handler, bandwidth):
+        self.handler   = handler
+        self.bandwidth = bandwidth
+        self.burst     = bandwidth * TRANSMIT_BURST_TIME
+        self.budgets   = {}
+        self.pending   = {}
+        self.chainInfo = {}
+
+    def _getChainInfo(self, chain):
+        if chain not in self.chainInfo:
+            mcu = getattr(chain, 'mcu', None)
+            if mcu is None and hasattr(chain, 'spi'):
+                mcu = chain.spi.get_mcu()
+            ledCount = chain.led_helper.led_count
+            colorData = getattr(chain, 'color_data', None)
+            colorOrder = getattr(chain, 'color_order', None)
+            if colorData is not None:
+                # neopixel: one byte per color of each LED
+                size = len(colorData)
+            elif hasattr(chain, 'spi'):
+                # dotstar: 4 bytes per LED plus start and end frame
+                size = 4 * ledCount + 8
+            elif isinstance(colorOrder, str):
+                size = len(colorOrder) * ledCount
+            elif colorOrder is not None:
+                size = sum(len(order) for order in colorOrder)
+            else:
+                size = 3 * ledCount
+            chunks = (size + TRANSMIT_CHUNK_SIZE - 1) // TRANSMIT_CHUNK_SIZE
+            self.chainInfo[chain] = (mcu, size + chunks * TRANSMIT_CHUNK_HEADER)
+        return self.chainInfo[chain]
+
+    def _getBudget(self, mcu, now):
+        tokens, lastTime = self.budgets.get(mcu, (self.burst, now))
+        return min(self.burst, tokens + (now - lastTime) * self.bandwidth)
+
+    def queue(self, chain, priority):
+        self.pending[chain] = max(priority, self.pending.get(chain, priority))
+
+    def flush(self):
+        reactor = self.handler.reactor
+        if not self.bandwidth:
+            for chain in self.pending:
+                self.handler._transmit_chain(chain)
+            self.pending = {}
+            return reactor.NEVER
+
+        #transmit the chains with the highest priority first. A chain is
+        #sent as long as its MCU has budget left (rounded to whole bytes),
+        #else it is deferred
+        now = reactor.monotonic()
+        nextTransmit = reactor.NEVER
+        for chain, priority in sorted(self.pending.items(),
+                                      key=lambda x: -x[1]):
+            mcu, size = self._getChainInfo(chain)
+            tokens = self._getBudget(mcu, now)
+            if tokens > -1.0:
+                self.handler._transmit_chain(chain)
+                del self.pending[chain]
+                tokens -= size
+            else:
+                nextTransmit = min(nextTransmit,
+                                   now - tokens / self.bandwidth)
+            self.budgets[mcu] = (tokens, now)
+        return nextTransmit
+
+######################################################################
+# Timing statistics, histogram of durations in seconds
+######################################################################
+
+class timingStats(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count     = 0
+        self.total     = 0.0
+        self.max       = 0.0
+        self.histogram = [0] * (len(STATS_BUCKETS) + 1)
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.histogram[bisect(STATS_BUCKETS, duration)] += 1
+
+    def get_status(self):
+        return {'count'    : self.count,
+                'avg'      : self.total / self.count if self.count else 0.0,
+                'max'      : self.max,
+                'histogram': list(self.histogram)}
+
+    def summary(self):
+        return "%d x, avg %.3f ms, max %.3f ms" % (
+            self.count, 1000.0 * self.get_status()['avg'], 1000.0 * self.max)
+
 ######################################################################
 # LED Effect handler
 ######################################################################
@@ -67,6 +788,8 @@ class ledFrameHandler:
         self.heaters = {}
         self.printProgress = 0
         self.effects = []
+        self.frameQueue = []
+        self.frameSequence = itertools.count()
         self.stepperPositions = [0.0,0.0,0.0]
         self.stepperTimer     = None
         self.heaterCurrent   = {}
@@ -87,9 +810,55 @@ class ledFrameHandler:
                                     desc=self.cmd_STOP_LED_EFFECTS_help)
         self.shutdown = False
 
+        compositor = config.getchoice('compositor',
+                                      {'auto': 'auto', 'python': 'python',
+                                       'numpy': 'numpy'}, 'auto')
+        if compositor == 'numpy' and numpy is None:
+            raise self.printer.config_error(
+                "Compositor 'numpy' requires the numpy python package")
+        self.useNumpy = compositor != 'python' and numpy is not None
+        if self.useNumpy:
+            self.compositor = numpyCompositor()
+        else:
+            self.compositor = pythonCompositor()
+
+        self.analytic = config.getchoice('rendering',
+                                         {'table': False, 'analytic': True},
+                                         'table')
+
+        self.tableCache = tableCache()
+        self.diskCache  = None
+        cachePath = config.get('table_cache_path', None)
+        if cachePath:
+            self.diskCache = diskCache(cachePath, 1024 * 1024 *
+                    config.getint('table_cache_size', 64, minval=1))
+        self.precomputeWorkers = config.getint('precompute_workers', 1,
+                                               minval=0)
+        self.precomputeTimeout = config.getfloat('precompute_timeout', 60.,
+                                                 above=0.)
+        self.configEffects = []
+        self.precomputed   = []
+
+        self.transmitter = transmitScheduler(self,
+                                config.getint('mcu_bandwidth', 0, minval=0))
+
+        self.adaptive      = config.getboolean('adaptive_frame_rate', False)
+        self.frameWakeTime = None
+        self.lateness      = 0.0
+        self.adaptTime     = 0.0
+
+        self.statsEnabled    = config.getboolean('stats', False)
+        self.compositorStats = timingStats()
+        self.transmitCount   = 0
+        self.gcode.register_command('LED_EFFECT_STATS',
+                                    self.cmd_LED_EFFECT_STATS,
+                                    desc=self.cmd_LED_EFFECT_STATS_help)
+
     cmd_STOP_LED_EFFECTS_help = 'Stops all led_effects'
+    cmd_LED_EFFECT_STATS_help = 'Reports render timing of all led_effects'
 
     def _transmit_chain(self, chain):
+        self.transmitCount += 1
 
         # Force update (dotstar workaround)
         if hasattr(chain, "prev_data"):
@@ -122,6 +891,68 @@ class ledFrameHandler:
                                                          self.reactor.NOW)
         self.frameTimer    = self.reactor.register_timer(self._getFrames, 
                                                          self.reactor.NOW)
+        self._precomputeTables()
+
+    def _precomputeTables(self):
+        #compute the frame tables of all effects in worker processes. The
+        #layers find them in the table cache when the effects create them
+        workers = self.precomputeWorkers or os.cpu_count() or 1
+        if workers < 2:
+            return
+        jobs = OrderedDict()
+        for effect in self.configEffects:
+            if effect.analytic:
+                continue
+            try:
+                effect._mapLeds()
+                layers = effect._parseLayers(effect._renderLayers())
+            except Exception:
+                #reported when the effect creates its layers
+                continue
+            for layer, kwargs in layers:
+                key = layer._tableKey(kwargs) + (False,)
+                if key in jobs or key in self.tableCache.tables:
+                    continue
+                if self.diskCache is not None and \
+                        os.path.exists(self.diskCache._fileName(key)):
+                    continue
+                jobs[key] = (layer.__name__, kwargs)
+
+        workers = min(workers, len(jobs))
+        if workers < 2:
+            return
+        #the workers are started by a fork server, forking Klipper itself
+        #while its threads hold locks can deadlock them. A worker that dies,
+        #e.g. killed when the host runs out of memory, breaks the pool and
+        #workers that hang are killed after the timeout, neither blocks
+        #startup
+        pool = ProcessPoolExecutor(workers,
+                    mp_context=multiprocessing.get_context('forkserver'))
+        try:
+            futures = [pool.submit(precomputeTable, job)
+                       for job in jobs.values()]
+            wait(futures, self.precomputeTimeout, FIRST_EXCEPTION)
+            results = [future.result(timeout=0) for future in futures]
+        except Exception as e:
+            logging.warning("led_effect: can't precompute frame tables, "
+                            "computing them serially: %s", str(e) or
+                            "timed out after %gs" % self.precomputeTimeout)
+            for process in list(pool._processes.values()):
+                process.kill()
+            pool.shutdown(wait=False)
+            return
+        pool.shutdown()
+
+        for (key, (name, kwargs)), result in zip(jobs.items(), results):
+            if result is None:
+                continue
+            count, data = result
+            size  = COLORS * kwargs['ledCount']
+            table = tableView(data, count, size)
+            if self.diskCache is not None:
+                table = self.diskCache.get(key, count, size, lambda: table)
+            #keep the tables until the effects picked them up
+            self.precomputed.append(self.tableCache.get(key, lambda: table))
 
     def _handle_shutdown(self):
         self.shutdown = True
@@ -184,6 +1015,15 @@ class ledFrameHandler:
             self.effects.remove(effect)
 
         self.effects.append(effect)
+        self.compositor.mapLeds(self.effects)
+        self.scheduleEffect(effect)
+
+    def scheduleEffect(self, effect):
+        #queue the effect for its next frame, entries that don't match the
+        #effect's nextEventTime anymore are outdated and get dropped
+        if effect.nextEventTime < self.reactor.NEVER:
+            heappush(self.frameQueue, (effect.nextEventTime,
+                                       next(self.frameSequence), effect))
 
     def _pollHeater(self, eventtime):
         for heater in self.heaters.keys():
@@ -216,53 +1056,84 @@ class ledFrameHandler:
             self.printProgress = int(p * 100)
         return eventtime + 1
 
-    def _getColorData(self, colors, fade):
-        clamp = (lambda x : 0.0 if x < 0.0 else 1.0 if x > 1.0 else x)
-        colors = [x*clamp(fade) for x in colors]
-        colors=colors + [0.0] * (4 - len(colors))
-        colors=colors[:4]
-        colors = [clamp(x) for x in colors]
-        return tuple(colors)
+    def requestFrames(self):
+        #render all effects changed by G-code commands together on the
+        #next reactor tick, instead of once per change
+        self.frameWakeTime = self.reactor.monotonic()
+        self.reactor.update_timer(self.frameTimer, self.reactor.NOW)
+
+    def _adaptFrameRates(self, eventtime, lateness):
+        #degrade the frame rate of the effect with the lowest priority one
+        #step at a time, while the frame timer runs late. Restore the effect
+        #with the highest priority first, once the timer is on time again
+        self.lateness += (lateness - self.lateness) * ADAPTIVE_SMOOTHING
+        if eventtime < self.adaptTime:
+            return
+        self.adaptTime = eventtime + ADAPTIVE_INTERVAL
+        if self.lateness > ADAPTIVE_LATE:
+            effects = [effect for effect in self.effects if effect.enabled
+                        and effect.frameSkip < effect.maxFrameSkip]
+            if effects:
+                min(effects, key=lambda x: x.priority).frameSkip += 1
+        elif self.lateness < ADAPTIVE_ON_TIME:
+            effects = [effect for effect in self.effects
+                        if effect.frameSkip > 1]
+            if effects:
+                max(effects, key=lambda x: x.priority).frameSkip -= 1
 
     def _getFrames(self, eventtime):
-        chainsToUpdate = set()
+        self.precomputed = []
+        if self.adaptive and self.frameWakeTime is not None \
+                and eventtime >= self.frameWakeTime:
+            self._adaptFrameRates(eventtime, eventtime - self.frameWakeTime)
 
-        frames = [(effect, effect.getFrame(eventtime)) for effect in self.effects]
+        dirtyLeds = {}
+        chainPriority = {}
 
-        #first set all LEDs to 0, that should be updated
-        for effect, (frame, update) in frames:
-            if update:
-                for i in range(effect.ledCount):
-                    chain,index=effect.leds[i]
-                    chain.led_helper.led_state[index] = (0.0, 0.0, 0.0, 0.0)
-                    chainsToUpdate.add(chain)
+        dueEffects = set()
+        while self.frameQueue and self.frameQueue[0][0] <= eventtime:
+            waketime, _, effect = heappop(self.frameQueue)
+            if waketime == effect.nextEventTime:
+                dueEffects.add(effect)
+
+        frames = [(effect, effect.getFrame(eventtime)) for effect in self.effects
+                    if effect in dueEffects]
 
-        #then sum up all effects for that LEDs
+        #collect the LEDs of all effects, whose frame changed
         for effect, (frame, update) in frames:
+            self.scheduleEffect(effect)
             if update:
-                for i in range(effect.ledCount):
-                    chain,index=effect.leds[i]
-                    
-                    current_state=list(chain.led_helper.led_state[index])
-                    effect_state=self._getColorData(frame[i*COLORS:i*COLORS+COLORS], 
-                                                    effect.fadeValue)
-
-                    next_state=[min(1.0,a+b) for a,b in \
-                                 zip(current_state, effect_state)]
-
-                    chain.led_helper.led_state[index] = tuple(next_state)
-                    chainsToUpdate.add(chain)
-
-        for chain in chainsToUpdate:
-            if not self.shutdown: 
-                self._transmit_chain(chain)
-        if self.effects:
-            next_eventtime=min(self.effects, key=lambda x: x.nextEventTime)\
-                            .nextEventTime
+                for chain, index in effect.leds:
+                    dirtyLeds.setdefault(chain, set()).add(index)
+                    chainPriority[chain] = max(effect.priority,
+                                    chainPriority.get(chain, effect.priority))
+
+        #then sum up all effects for those LEDs, only chains whose LED
+        #colors changed need to be transmitted
+        if self.statsEnabled:
+            start = perf_counter()
+            changedChains = self.compositor.compose(dirtyLeds)
+            self.compositorStats.add(perf_counter() - start)
+        else:
+            changedChains = self.compositor.compose(dirtyLeds)
+
+        for chain in changedChains:
+            self.transmitter.queue(chain, chainPriority[chain])
+        if not self.shutdown:
+            nextTransmit = self.transmitter.flush()
         else:
-            next_eventtime = eventtime
-        # run at least with 10Hz
-        next_eventtime=min(next_eventtime, eventtime + 0.1) 
+            nextTransmit = self.reactor.NEVER
+
+        #sleep until the next effect is due, or until an effect gets enabled
+        while self.frameQueue and \
+                self.frameQueue[0][0] != self.frameQueue[0][2].nextEventTime:
+            heappop(self.frameQueue)
+        if self.frameQueue:
+            next_eventtime = min(self.frameQueue[0][0], nextTransmit)
+        else:
+            next_eventtime = nextTransmit
+        self.frameWakeTime = max(next_eventtime, self.reactor.monotonic())
+        self.reactor.update_timer(self.frameTimer, next_eventtime)
         return next_eventtime
     
     def parse_chain(self, chain):
@@ -318,6 +1189,49 @@ class ledFrameHandler:
                     effect.set_fade_time(gcmd.get_float('FADETIME', 0.0))
                 effect.set_enabled(False)
 
+    def cmd_LED_EFFECT_STATS(self, gcmd):
+        enable = gcmd.get_int('ENABLE', None, minval=0, maxval=1)
+        if enable is not None:
+            self.statsEnabled = bool(enable)
+        if gcmd.get_int('RESET', 0) >= 1 or enable:
+            self.resetStats()
+
+        if not self.statsEnabled:
+            gcmd.respond_info("LED effect statistics are disabled, "
+                              "enable them with LED_EFFECT_STATS ENABLE=1")
+            return
+
+        msg = ["compositor: %s" % (self.compositorStats.summary(),),
+               "transmits: %d" % (self.transmitCount,),
+               "layer tables: %s" % (self.tableCache.summary(),)]
+        if self.diskCache is not None:
+            msg.append("table cache: %s" % (self.diskCache.summary(),))
+        for effect in self.effects:
+            msg.append("%s: render %s, blend %s" % (effect.name,
+                       effect.renderStats.summary(),
+                       effect.blendStats.summary()))
+            for i, layer in enumerate(effect.layers):
+                msg.append("  %s: %s" % (layer.getStatsName(i),
+                                         layer.renderStats.summary()))
+        gcmd.respond_info("\n".join(msg))
+
+    def resetStats(self):
+        self.compositorStats.reset()
+        self.transmitCount = 0
+        for effect in self.effects:
+            effect.renderStats.reset()
+            effect.blendStats.reset()
+            for layer in effect.layers:
+                layer.renderStats.reset()
+
+    def get_status(self, eventtime):
+        if not self.statsEnabled:
+            return {'stats_enabled': False}
+        return {'stats_enabled': True,
+                'compositor'   : self.compositorStats.get_status(),
+                'transmits'    : self.transmitCount,
+                'layer_tables' : self.tableCache.get_status()}
+
 def load_config(config):
     return ledFrameHandler(config)
 
@@ -332,41 +1246,101 @@ class ledEffect:
         self.gcode        = self.printer.lookup_object('gcode')
         self.gcode_macro  = self.printer.load_object(config, 'gcode_macro')
         self.handler      = self.printer.load_object(config, 'led_effect')
-        self.frameRate    = 1.0 / config.getfloat('frame_rate', 
+        self.handler.configEffects.append(self)
+        frameRate         = config.getfloat('frame_rate',
                                         default=24, minval=1, maxval=60)
+        self.frameRate    = 1.0 / frameRate
+        self.frameSkip    = 1
+        self.frameSteps   = 1
+        self.playTime     = None
+        self.maxFrameSkip = max(1, int(frameRate / config.getfloat(
+                                        'min_frame_rate',
+                                        default=min(5.0, frameRate),
+                                        minval=1, maxval=frameRate)))
         self.enabled      = False
         self.iteration    = 0
         self.layers       = []
+        self.visibleLayers = []
         self.analogValue  = 0
         self.button_state = 0
         self.fadeValue    = 0.0
         self.fadeTime     = 0.0
         self.fadeEndTime  = 0
-
-        #Basic functions for layering colors. t=top and b=bottom color
-        self.blendingModes  = {
-            'top'       : (lambda t, b: t ),
-            'bottom'    : (lambda t, b: b ),
-            'add'       : (lambda t, b: t + b ),
-            'subtract'  : (lambda t, b: (b - t) * (b - t > 0)),
-            'subtract_b': (lambda t, b: (t - b) * (t - b > 0)),
-            'difference': (lambda t, b: (t - b) * (t > b) + (b - t) * (t <= b)),
-            'average'   : (lambda t, b: 0.5 * (t + b)),
-            'multiply'  : (lambda t, b: t * b),
-            'divide'    : (lambda t, b: t / b if b > 0 else 0 ),
-            'divide_inv': (lambda t, b: b / t if t > 0 else 0 ),
-            'screen'    : (lambda t, b: 1.0 - (1.0-t)*(1.0-b) ),
-            'lighten'   : (lambda t, b: t * (t > b) +  b * (t <= b)),
-            'darken'    : (lambda t, b: t * (t < b) +  b * (t >= b)),
-            'overlay'   : (lambda t, b: \
-                                2.0 * t * b if t > 0.5 else \
-                                1.0 - (2.0 * (1.0-t) * (1.0-b)))
-           }
+        self.lastInputs   = None
+        self.bakedFrames  = None
+        self.bakeNumber   = 0
+        self.bakeStart    = ()
+        self.renderStats  = timingStats()
+        self.blendStats   = timingStats()
+
+        #Basic functions for layering colors. t=top and b=bottom frame.
+        #All functions blend into b in place, for numpy t and the boolean
+        #array m are used as scratch space
+        if self.handler.useNumpy:
+            self.blendingModes  = {
+                'top'       : (lambda t, b, m: numpy.copyto(b, t)),
+                'bottom'    : (lambda t, b, m: None),
+                'add'       : (lambda t, b, m: numpy.add(t, b, out=b)),
+                'subtract'  : (lambda t, b, m: numpy.maximum(
+                                    numpy.subtract(b, t, out=b), 0.0, out=b)),
+                'subtract_b': (lambda t, b, m: numpy.maximum(
+                                    numpy.subtract(t, b, out=b), 0.0, out=b)),
+                'difference': (lambda t, b, m: numpy.abs(
+                                    numpy.subtract(t, b, out=b), out=b)),
+                'average'   : (lambda t, b, m: numpy.multiply(
+                                    numpy.add(t, b, out=b), 0.5, out=b)),
+                'multiply'  : (lambda t, b, m: numpy.multiply(t, b, out=b)),
+                'divide'    : (lambda t, b, m: numpy.multiply(
+                                    numpy.divide(t, b, out=t,
+                                        where=numpy.greater(b, 0.0, out=m)),
+                                    m, out=b)),
+                'divide_inv': (lambda t, b, m: numpy.multiply(
+                                    numpy.divide(b, t, out=b,
+                                        where=numpy.greater(t, 0.0, out=m)),
+                                    m, out=b)),
+                'screen'    : (lambda t, b, m: numpy.subtract(1.0,
+                                    numpy.multiply(
+                                        numpy.subtract(1.0, t, out=t),
+                                        numpy.subtract(1.0, b, out=b),
+                                        out=b), out=b)),
+                'lighten'   : (lambda t, b, m: numpy.maximum(t, b, out=b)),
+                'darken'    : (lambda t, b, m: numpy.minimum(t, b, out=b)),
+                'overlay'   : numpyOverlay
+               }
+        else:
+            self.blendingModes  = {
+                'top'       : pythonTop,
+                'bottom'    : (lambda t, b: None),
+                'add'       : pythonAdd,
+                'subtract'  : pythonSubtract,
+                'subtract_b': pythonSubtractB,
+                'difference': pythonDifference,
+                'average'   : pythonAverage,
+                'multiply'  : pythonMultiply,
+                'divide'    : pythonDivide,
+                'divide_inv': pythonDivideInv,
+                'screen'    : pythonScreen,
+                'lighten'   : pythonLighten,
+                'darken'    : pythonDarken,
+                'overlay'   : pythonOverlay
+               }
 
         self.name         = config.get_name().split()[1]
 
         self.autoStart    = config.getboolean('autostart', False)
         self.runOnShutown = config.getboolean('run_on_error', False)
+        self.priority     = config.getint('priority', 0)
+        self.bake         = config.getboolean('bake', False)
+        self.clockPlayback = config.getchoice('playback',
+                                {'frame': False, 'clock': True}, 'frame')
+        self.analytic     = config.getchoice('rendering',
+                                {'table': False, 'analytic': True},
+                                'analytic' if self.handler.analytic else 'table')
+        self.frameCache   = frameCache(1024 * config.getint(
+                                        'frame_cache_size', 1024, minval=1))
+        self.layerCacheSize = config.getint('layer_cache_size', 8, minval=0)
+        self.layerCache   = OrderedDict()
+        self.lineCache    = OrderedDict()
         self.heater       = config.get('heater', None)
         self.analogPin    = config.get('analog_pin', None)
         self.buttonPins   = config.getlist('button_pins', None)
@@ -377,6 +1351,13 @@ class ledEffect:
         self.configLayers = []
         self.configLeds   = config.get('leds')
 
+        #enumerate all effects from the subclasses of _layerBase...
+        self.availableLayers = {str(c).rpartition('.layer')[2]\
+                                 .replace("'>", "")\
+                                 .lower() : c
+                                   for c in self._layerBase.__subclasses__()
+                                   if str(c).startswith("<class")}
+
         self.nextEventTime = 0
         self.printer.register_event_handler('klippy:ready', self._handle_ready)
         self.gcode.register_mux_command('SET_LED_EFFECT', 'EFFECT', self.name,
@@ -404,14 +1385,28 @@ class ledEffect:
     cmd_SET_LED_EFFECT_help = 'Starts or Stops the specified led_effect'
 
     def _handle_ready(self):
-        self.configChains = self.configLeds.split('\n')
-        self.ledChains    = []
-        self.leds         = []
         self.enabled = self.autoStart
         if not self.enabled:
             self.nextEventTime = self.handler.reactor.NEVER
         self.printer.register_event_handler('klippy:shutdown', 
                                     self._handle_shutdown)
+        self._mapLeds()
+
+        #effect frames are rendered into these buffers
+        self.frameBuffer = self._emptyFrame()
+        self.frame       = self.frameBuffer
+        if self.handler.useNumpy:
+            self.layerBuffer = numpy.zeros(COLORS * self.ledCount)
+            self.blendMask   = numpy.zeros(COLORS * self.ledCount, bool)
+        else:
+            self.zeroFrame   = self._emptyFrame()
+
+        self._generateLayers()
+
+    def _mapLeds(self):
+        self.configChains = self.configLeds.split('\n')
+        self.ledChains    = []
+        self.leds         = []
         #map each LED from the chains to the "pixels" in the effect frame
         for chain in self.configChains:
             chainName, ledIndices = self.handler.parse_chain(chain)
@@ -430,92 +1425,261 @@ class ledEffect:
                         self.leds.append((ledChain, led))
 
         self.ledCount = len(self.leds)
-        self.frame = [0.0] * COLORS * self.ledCount
-
-        #enumerate all effects from the subclasses of _layerBase...
-        self.availableLayers = {str(c).rpartition('.layer')[2]\
-                                 .replace("'>", "")\
-                                 .lower() : c
-                                   for c in self._layerBase.__subclasses__()
-                                   if str(c).startswith("<class")}
-        self._generateLayers()
 
-    def _generateLayers(self, context=None):
-        self.layers = []
+    def _renderLayers(self, context=None):
         if context is None:
             context = self.gcode_macro.create_template_context()
             context.update({'params': {}, 'rawparams': ''})
-        self.configLayers = self.layerTempl.render(context)
-        for layer in [line for line \
-            in self.configLayers.split('\n') if line.strip()]:
-
-            parms = [parameter.strip() for parameter \
-                in layer.split() if parameter.strip()]
-
-            if not parms[0] in self.availableLayers:
-                raise self.printer\
-                    .config_error("LED Effect '%s' in section '%s' is not a " \
-                        "valid effect layer" % (parms[0], self.name))
+        return self.layerTempl.render(context)
 
-            if not parms[3] in self.blendingModes:
-                raise self.printer.config_error("Blending mode '%s' in section "
-                     "'%s' is not a valid blending mode"\
-                         % (parms[3], self.name))
-
-            layer = self.availableLayers[parms[0]]
-
-            pad = lambda x: x + [0.0] * (COLORS - len(x))
-            convert = lambda s: float(s)
+    def _generateLayers(self, context=None):
+        self.lastInputs = None
+        self.configured = context is None
+        self.configLayers = self._renderLayers(context)
+        #effects with recalculate are often activated with a few sets of
+        #parameters. The layers of recently used ones are kept and reused
+        stack = self.layerCache.pop(self.configLayers, None)
+        previous = self.layers
+        if stack is not None and stack[0] is previous:
+            pass
+        elif stack is None:
+            #layers with unchanged parameters are kept and continue their
+            #animation, only the changed ones are created
+            self._syncFrameNumbers()
+            unchanged = {}
+            for layer in previous:
+                unchanged.setdefault(layer.tableKey + (layer.blendingMode,),
+                                     []).append(layer)
+            self.layers = []
+            for layer, kwargs in reversed(
+                    self._parseLayers(self.configLayers)):
+                kept = unchanged.get(layer._tableKey(kwargs) +
+                                     (kwargs['blendingMode'],))
+                self.layers.append(kept.pop() if kept else
+                                   layer(handler      = self,
+                                         frameHandler = self.handler,
+                                         **kwargs))
+            self._cullLayers()
+            self._bakeLayers()
+        else:
+            self._syncFrameNumbers()
+            self.layers, self.visibleLayers, self.bakedFrames, \
+                self.bakeStart = stack
+            self.bakeNumber = 0
+            for layer in self.layers:
+                if not any(layer is p for p in previous):
+                    layer.frameNumber = 0
+            if self.bakedFrames is not None and \
+                    self._frameNumbers() != self.bakeStart:
+                self._bakeLayers()
+        if self.layerCacheSize:
+            self.layerCache[self.configLayers] = (self.layers,
+                                                  self.visibleLayers,
+                                                  self.bakedFrames,
+                                                  self.bakeStart)
+            while len(self.layerCache) > self.layerCacheSize:
+                self.layerCache.popitem(last=False)
+        #the LEDs of an effect don't change with its layers, it is only
+        #registered and mapped once
+        if self not in self.handler.effects:
+            self.handler.addEffect(self)
+
+    #returns the class and the parameters of each layer in configLayers
+    def _parseLayers(self, configLayers):
+        layers = []
+        for line in [line.strip() for line \
+            in configLayers.split('\n') if line.strip()]:
+            layer = self.lineCache.pop(line, None)
+            if layer is None:
+                layer = self._parseLayer(line)
+            if self.layerCacheSize:
+                self.lineCache[line] = layer
+                while len(self.lineCache) > LINE_CACHE_SIZE:
+                    self.lineCache.popitem(last=False)
+            layers.append(layer)
+        return layers
+
+    def _parseLayer(self, line):
+        parms = [parameter.strip() for parameter \
+            in line.split() if parameter.strip()]
+
+        if not parms[0] in self.availableLayers:
+            raise self.printer\
+                .config_error("LED Effect '%s' in section '%s' is not a " \
+                    "valid effect layer" % (parms[0], self.name))
+
+        if not parms[3] in self.blendingModes:
+            raise self.printer.config_error("Blending mode '%s' in section "
+                 "'%s' is not a valid blending mode"\
+                     % (parms[3], self.name))
+
+        layer = self.availableLayers[parms[0]]
+
+        pad = lambda x: x + [0.0] * (COLORS - len(x))
+        convert = lambda s: float(s)
                 
-            try:
-                palette="".join(parms[4:])                                      # join all elements of the list
-                palette="".join(palette.split())                                # remove whitespaces
-                palette=palette.strip(",")
-                palette=palette.split("),(")                                    # split colors
-                palette=[c.split(",") for c in palette]                         # split color components
-                palette=[[convert(k.strip("()")) for k in c] for c in palette]  # convert to float
-                for i in palette: 
-                    if len(i) > COLORS: 
-                        raise Exception(
-                            "Color %s has too many elements." % (str(i),))
-                palette=[pad(c) for c in palette]                               # pad to COLORS colors
-                palette=[k for c in palette for k in c]                         # flatten list
-            except Exception as e:
-                raise self.printer.config_error(
-                    "Error parsing palette in '%s' for layer \"%s\": %s"\
-                        % (self.config.get_name(), parms[0], e,))
-            self.layers.insert(0, layer(handler       = self,
-                                        frameHandler  = self.handler,
-                                        effectRate    = float(parms[1]),
-                                        effectCutoff  = float(parms[2]),
-                                        paletteColors = palette,
-                                        frameRate     = self.frameRate,
-                                        ledCount      = len(self.leds),
-                                        blendingMode  = parms[3]))
-
-        self.handler.addEffect(self)
+        try:
+            palette="".join(parms[4:])                                      # join all elements of the list
+            palette="".join(palette.split())                                # remove whitespaces
+            palette=palette.strip(",")
+            palette=palette.split("),(")                                    # split colors
+            palette=[c.split(",") for c in palette]                         # split color components
+            palette=[[convert(k.strip("()")) for k in c] for c in palette]  # convert to float
+            for i in palette: 
+                if len(i) > COLORS: 
+                    raise Exception(
+                        "Color %s has too many elements." % (str(i),))
+            palette=[pad(c) for c in palette]                               # pad to COLORS colors
+            palette=[k for c in palette for k in c]                         # flatten list
+        except Exception as e:
+            raise self.printer.config_error(
+                "Error parsing palette in '%s' for layer \"%s\": %s"\
+                    % (self.config.get_name(), parms[0], e,))
+        return (layer, dict(effectRate    = float(parms[1]),
+                            effectCutoff  = float(parms[2]),
+                            paletteColors = palette,
+                            frameRate     = self.frameRate,
+                            ledCount      = len(self.leds),
+                            blendingMode  = parms[3]))
+
+    def _cullLayers(self):
+        #layers below a layer that always replaces them, with 'top' or by
+        #multiplying them with zero, and layers blended with 'bottom' don't
+        #change the frame. They are neither rendered nor blended
+        start = 0
+        for i, layer in enumerate(self.layers):
+            if layer.blendingMode == 'top' and layer.alwaysRenders():
+                start = i
+            elif layer.blendingMode == 'multiply' and layer.isZero():
+                start = i + 1
+        self.visibleLayers = [layer for layer in self.layers[start:]
+                              if layer.blendingMode != 'bottom']
+
+    def _bakeLayers(self):
+        #the frames of a stack of periodic layers repeat after the least
+        #common multiple of the layers' frame counts. Blend that period
+        #once, then each frame is a lookup
+        self.bakedFrames = None
+        self.bakeNumber  = 0
+        self.bakeStart   = self._frameNumbers()
+        if not self.bake or not self.visibleLayers:
+            return
+        if not all(layer.isPeriodic() for layer in self.visibleLayers):
+            return
+        period = 1
+        for layer in self.visibleLayers:
+            period = period * layer.frameCount // gcd(period,
+                                                      layer.frameCount)
+        if period * COLORS * self.ledCount > BAKE_MAX_SIZE:
+            return
+
+        #each frame is blended in one buffer and stored in a single
+        #float32 array, so baking needs little more than its result
+        size  = COLORS * self.ledCount
+        frame = self._emptyFrame()
+        zero  = self._emptyFrame()
+        if self.handler.useNumpy:
+            baked = numpy.empty((period, size), numpy.float32)
+        else:
+            values = array('f', [0.0]) * (period * size)
+        for i in range(period):
+            frame[:] = zero
+            for layer in self.visibleLayers:
+                self._blendLayer(layer, layer.thisFrame[
+                        (layer.frameNumber + i) % layer.frameCount], frame)
+            if self.handler.useNumpy:
+                baked[i] = frame
+            else:
+                values[i * size:(i + 1) * size] = array('f', frame)
+
+        if self.handler.useNumpy:
+            self.bakedFrames = baked
+        else:
+            values = memoryview(values)
+            self.bakedFrames = [values[i * size:(i + 1) * size]
+                                for i in range(period)]
+
+    #baked frame i shows the visible layers at bakeStart + i
+    def _frameNumbers(self):
+        return tuple(layer.frameNumber for layer in self.visibleLayers)
+
+    #the layers don't advance while baked frames are shown, set them to
+    #the frames of the baked frame shown last
+    def _syncFrameNumbers(self):
+        if self.bakedFrames is None:
+            return
+        for layer, start in zip(self.visibleLayers, self.bakeStart):
+            layer.frameNumber = (start + self.bakeNumber) % layer.frameCount
+
+    def _emptyFrame(self):
+        if self.handler.useNumpy:
+            return numpy.zeros(COLORS * self.ledCount)
+        return [0.0] * COLORS * self.ledCount
+
+    def _clearFrame(self):
+        if self.handler.useNumpy:
+            self.frameBuffer.fill(0.0)
+        else:
+            self.frameBuffer[:] = self.zeroFrame
+        self.frame = self.frameBuffer
+
+    def _blendLayer(self, layer, layerFrame, frame):
+        blend = self.blendingModes[layer.blendingMode]
+        if self.handler.useNumpy:
+            blend(frameToArray(layerFrame, self.layerBuffer), frame,
+                  self.blendMask)
+        else:
+            blend(layerFrame, frame)
 
     def getFrame(self, eventtime):
         if not self.enabled and self.fadeValue <= 0.0:
             if self.nextEventTime < self.handler.reactor.NEVER:
                 # Effect has just been disabled. Set colors to 0 and update once.
                 self.nextEventTime = self.handler.reactor.NEVER
-                self.frame = [0.0] * COLORS * self.ledCount
+                self._clearFrame()
                 update = True
             else:
                 update = False
         else:
-            update = True
+            update = False
             if eventtime >= self.nextEventTime:
-                self.nextEventTime = eventtime + self.frameRate
+                self.nextEventTime = eventtime + self.frameRate * self.frameSkip
 
-                self.frame = [0.0] * COLORS * self.ledCount
-                for layer in self.layers:
-                    layerFrame = layer.nextFrame(eventtime)
+                # Layers driven by sensor values only need to be rendered
+                # again, when one of their inputs changed
+                inputs = self._getInputs()
+                if inputs is not None and inputs == self.lastInputs:
+                    return self.frame, update
 
-                    if layerFrame:
-                        blend = self.blendingModes[layer.blendingMode]
-                        self.frame = [blend(t, b) for t, b in zip(layerFrame, self.frame)]
+                update = True
+                self.frameSteps = self._getFrameSteps(eventtime)
+                stats = self.handler.statsEnabled
+                if stats:
+                    renderStart = perf_counter()
+                    blendTime = 0.0
+
+                if self.bakedFrames is not None:
+                    self.bakeNumber = (self.bakeNumber + self.frameSteps) \
+                        % len(self.bakedFrames)
+                    self.frame = self.bakedFrames[self.bakeNumber]
+                else:
+                    self._clearFrame()
+                    for layer in self.visibleLayers:
+                        if stats:
+                            layerStart = perf_counter()
+                        layerFrame = layer.nextFrame(eventtime)
+                        if stats:
+                            blendStart = perf_counter()
+                            layer.renderStats.add(blendStart - layerStart)
+
+                        if layerFrame:
+                            self._blendLayer(layer, layerFrame, self.frame)
+                        if stats:
+                            blendTime += perf_counter() - blendStart
+
+                if stats:
+                    self.blendStats.add(blendTime)
+                    self.renderStats.add(perf_counter() - renderStart)
 
                 if (self.fadeEndTime > eventtime) and (self.fadeTime > 0.0):
                     remainingFade = ((self.fadeEndTime - eventtime) / self.fadeTime)
@@ -523,20 +1687,49 @@ class ledEffect:
                     remainingFade = 0.0    
 
                 self.fadeValue = 1.0-remainingFade if self.enabled else remainingFade
+                self.lastInputs = inputs if remainingFade == 0.0 else None
 
         return self.frame, update
 
+    def _getFrameSteps(self, eventtime):
+        #number of frames the animations advance with this render. With
+        #clock playback it follows the time passed since the last render,
+        #so late or skipped renders don't slow the animations down
+        if not self.clockPlayback:
+            return self.frameSkip
+        if self.playTime is None:
+            self.playTime = eventtime
+            return 1
+        steps = int((eventtime - self.playTime) / self.frameRate + 0.5)
+        self.playTime += steps * self.frameRate
+        return steps
+
+    def _getInputs(self):
+        inputs = [layer.getInputs() for layer in self.visibleLayers]
+        if None in inputs:
+            return None
+        return inputs
+
     def set_enabled(self, state):
         if self.enabled != state:
             self.enabled = state
             self.nextEventTime = self.handler.reactor.NOW
-            self.handler._getFrames(self.handler.reactor.NOW)
+            self.lastInputs = None
+            self.playTime = None
+            self.handler.scheduleEffect(self)
+            self.handler.requestFrames()
     
     def reset_frame(self):
+        self.lastInputs = None
+        self.playTime   = None
+        self.bakeNumber = 0
         for layer in self.layers:
             layer.frameNumber = 0
+        if self.bakedFrames is not None and any(self.bakeStart):
+            self._bakeLayers()
 
     def set_fade_time(self, fadetime):
+        self.lastInputs = None
         self.fadeTime = fadetime
         self.fadeEndTime = self.handler.reactor.monotonic() + fadetime
         if self.fadeTime == 0.0:
@@ -570,7 +1763,14 @@ class ledEffect:
             self.set_enabled(True)
     
     def get_status(self, eventtime):
-        return {'enabled':self.enabled}
+        if not self.handler.statsEnabled:
+            return {'enabled':self.enabled}
+        return {'enabled':self.enabled,
+                'stats'  : {'render': self.renderStats.get_status(),
+                            'blend' : self.blendStats.get_status(),
+                            'layers': {layer.getStatsName(i):
+                                           layer.renderStats.get_status()
+                                       for i, layer in enumerate(self.layers)}}}
 
     def _handle_shutdown(self):
         self.set_enabled(self.runOnShutown)
@@ -599,66 +1799,126 @@ class ledEffect:
             self.frameRate       = kwargs['frameRate']
             self.blendingMode    = kwargs['blendingMode']
             self.frameNumber     = 0
+            self.tableKey        = self._tableKey(kwargs)
             self.thisFrame       = []
             self.frameCount      = 1
             self.lastAnalog      = 0
+            self.renderStats     = timingStats()
 
         def nextFrame(self, eventtime):
             if not self.frameCount:
                 return [0] * COLORS * self.ledCount
-            self.frameNumber += 1
-            self.frameNumber = self.frameNumber * \
-                ( self.frameNumber < self.frameCount )
+            self.frameNumber = (self.frameNumber + self.handler.frameSteps) \
+                % self.frameCount
             self.lastFrameTime = eventtime
 
             return self.thisFrame[self.frameNumber]
 
-        def _decayTable(self, factor=1, rate=1):
-
-            frame = []
-
-            p = (1.0 / self.frameRate)
-            r = (p/15.0)*factor
-
-            for s in range(0, int((rate<1)+rate)):
-                frame.append(1.0)
-                for x in range(2, int(p / rate)):
-                    b = exp(1)**-(x/r)
-                    if b>.004:
-                        frame.append(b)
+        # Layers of the same type with equal parameters have equal frames
+        @classmethod
+        def _tableKey(cls, kwargs):
+            return (cls.__name__, kwargs['ledCount'], kwargs['frameRate'],
+                    kwargs['effectRate'], kwargs['effectCutoff'],
+                    tuple(colorArray(COLORS, kwargs['paletteColors'])))
+
+        def getStatsName(self, index):
+            return "%d_%s" % (index, type(self).__name__[5:].lower())
+
+        # Layers rendering their frames at runtime fill this buffer
+        def _allocFrame(self):
+            self.frameBuffer = [0.0] * COLORS * self.ledCount
+            self.colors = [tuple(self.paletteColors[c])
+                           for c in range(len(self.paletteColors))]
+
+        def _solidFrame(self, color):
+            frame = self.frameBuffer
+            for i in range(0, len(frame), COLORS):
+                frame[i:i+COLORS] = color
             return frame
 
-        def _gradient(self, palette, steps, reverse=False, toFirst=False):
-            palette = colorArray(COLORS, palette[:])
-            if reverse: palette.reverse()
+        # True if the frames of the layer only depend on the frame number
+        def isPeriodic(self):
+            return self.frameCount > 0 and \
+                type(self).nextFrame is ledEffect._layerBase.nextFrame
 
-            if len(palette) == 1:
-                return colorArray(COLORS, palette * steps)
+        # False if nextFrame may return None, leaving the layers below visible
+        def alwaysRenders(self):
+            return True
 
-            if toFirst:
-                palette += palette[0]
+        # True if all frames of the layer are black
+        def isZero(self):
+            return self.isPeriodic() and not any(self.paletteColors)
 
-            paletteIntervals = len(palette)-1
-            stepIntervals = steps if toFirst else steps-1
-            if stepIntervals != 0:
-                intervals_per_step = float(paletteIntervals) / stepIntervals
-            else:
-                intervals_per_step = 0
+        # Values the frame of the layer solely depends on, None if the layer
+        # has to be rendered for every frame
+        def getInputs(self):
+            return None
 
-            gradient=palette[0]
+        # Inputs of layers driven by the heater of the effect
+        def _heaterInputs(self):
+            return (self.frameHandler.heaterCurrent[self.handler.heater],
+                    self.frameHandler.heaterTarget[self.handler.heater],
+                    self.frameHandler.heaterLast[self.handler.heater])
+
+        # Frame table of count frames, frame i is rendered by render(i).
+        # Tables are computed on startup, lazy tables on first use of a
+        # frame. In analytic mode each frame is rendered when it is shown.
+        # Lazy tables are shared between effects, the rendered frames are
+        # kept in the frame cache of the effect showing them
+        def _frames(self, count, render, lazy=False):
+            def build():
+                if self.handler.analytic or lazy:
+                    return lazyFrames(None, count, render)
+                return frameTable(render(i) for i in range(count))
+
+            key = self.tableKey + (self.handler.analytic,)
+            #only tables of the configured layers are stored on disk, not
+            #those of layers recalculated at runtime
+            disk = self.frameHandler.diskCache
+            if lazy and not self.handler.analytic:
+                table = self.frameHandler.tableCache.get(key, build)
+                return lazyFrames(self.handler.frameCache, count,
+                                  table.__getitem__, table)
+            if disk is None or lazy or self.handler.analytic or \
+                    not self.handler.configured:
+                return self.frameHandler.tableCache.get(key, build)
+            return self.frameHandler.tableCache.get(key,
+                lambda: disk.get(key, count, COLORS * self.ledCount, build))
+
+        # Frame i shows all LEDs in the color gradient[i]
+        def _colorFrames(self):
+            return self.frameHandler.tableCache.get(self.tableKey + ('colors',),
+                lambda: colorTable(solidFrame(tuple(self.gradient[i]),
+                                              self.ledCount)
+                                   for i in range(len(self.gradient))))
+
+        # Window of the strip's length, starting offset LEDs into ring
+        def _window(self, ring, offset):
+            view = colorArray._view(ring.n, ring.data)
+            view.offset = offset % len(ring)
+            return view[:self.ledCount]
+
+        # Frames of ring shifted by shift LEDs per step, each shown repeat
+        # times
+        def _shiftFrames(self, ring, shift, direction, steps, repeat,
+                         first=0):
+            start = ring.offset
+            if direction:
+                shift *= -1
+            if abs(shift) >= len(ring):
+                shift = 0
+
+            def render(i):
+                return self._window(ring,
+                                    start + (i // repeat + first) * shift)
+            return self._frames(max(0, steps) * repeat, render, lazy=True)
 
-            for i in range(1,steps):
-                j = intervals_per_step * i
-                k = int(j) 
-                r = j-k
-                k = min(k, len(palette)-1)
+        def _decayTable(self, factor=1, rate=1):
+            return decayTable(self.frameRate, factor, rate)
 
-                if ( (k+1) >= len(palette) ) | (r == 0.0) :
-                    z = palette[k]
-                else:
-                    z = [((1-r)*palette[k][m] + r*palette[k+1][m]) for m in range(COLORS)]
-                gradient += z
-            return gradient
+        def _gradient(self, palette, steps, reverse=False, toFirst=False):
+            return gradientTable(tuple(colorArray(COLORS, palette)), steps,
+                                 reverse, toFirst)
 
     #Individual effects inherit from the LED Effect Base class
     #each effect must support the nextFrame() method either by
@@ -678,6 +1938,9 @@ class ledEffect:
             self.thisFrame.append(gradient[0:self.ledCount])
             self.frameCount = len(self.thisFrame)
 
+        def getInputs(self):
+            return ()
+
     #Slow pulsing of color
     class layerBreathing(_layerBase):
         def __init__(self,  **kwargs):
@@ -703,13 +1966,15 @@ class ledEffect:
 
                 brightness.append(v)
 
-            for c in range(0, len(self.paletteColors)):
-                color = self.paletteColors[c]
-
-                for b in brightness:
-                    self.thisFrame += [[b * i for i in color] * self.ledCount]
-
+            self.brightness = brightness
+            self.thisFrame = self._frames(
+                len(self.paletteColors) * len(brightness), self._render)
             self.frameCount = len(self.thisFrame)
+
+        def _render(self, index):
+            c, b = divmod(index, len(self.brightness))
+            return [self.brightness[b] * i
+                    for i in self.paletteColors[c]] * self.ledCount
     class layerLinearFade(_layerBase):
         def __init__(self,  **kwargs):
             super(ledEffect.layerLinearFade, self).__init__(**kwargs)
@@ -717,12 +1982,10 @@ class ledEffect:
             gradientLength = int(self.effectRate / self.frameRate) 
             if gradientLength == 0: gradientLength = 1
 
-            gradient   = colorArray(COLORS, self._gradient(self.paletteColors, 
+            self.gradient = colorArray(COLORS, self._gradient(self.paletteColors, 
                                                    gradientLength, toFirst=True))
 
-            for i in range(gradientLength):
-                self.thisFrame.append(gradient[i]*self.ledCount)
-
+            self.thisFrame = self._colorFrames()
             self.frameCount = len(self.thisFrame)
 
     #Turns the entire strip on and off
@@ -736,46 +1999,55 @@ class ledEffect:
             frameCountOff = int(( 1.0 / self.frameRate ) * self.effectRate\
                  * (1-dutyCycle))
 
-            for c in range(0, len(self.paletteColors)):
-                color = self.paletteColors[c]
-                self.thisFrame += [color * self.ledCount] * frameCountOn
-                self.thisFrame += [[0]*COLORS * self.ledCount] * frameCountOff
+            self.frameCountOn = frameCountOn
+            self.period   = frameCountOn + frameCountOff
+            self.onFrames = [self.paletteColors[c:c+1] * self.ledCount
+                             for c in range(0, len(self.paletteColors))]
+            self.offFrame = [0]*COLORS * self.ledCount
 
+            self.thisFrame = self._frames(
+                len(self.paletteColors) * self.period, self._render)
             self.frameCount = len(self.thisFrame)
 
+        def _render(self, index):
+            c, f = divmod(index, self.period)
+            return self.onFrames[c] if f < self.frameCountOn else self.offFrame
+
     #Random flashes with decay
     class layerTwinkle(_layerBase):
         def __init__(self,  **kwargs):
             super(ledEffect.layerTwinkle, self).__init__(**kwargs)
 
-            self.thisFrame = colorArray(COLORS, ([0.0]*COLORS) * self.ledCount)
+            self._allocFrame()
+            self.black = (0.0,) * COLORS
             self.lastBrightness  = [-1] * self.ledCount
             self.decayTable = self._decayTable(factor=1 / self.effectCutoff)
             self.decayLen = len(self.decayTable)
             self.colorCount = len(self.paletteColors) - 1
 
         def nextFrame(self, eventtime):
+            frame = self.frameBuffer
 
             for i in range(0, self.ledCount):
 
                 r = randint(0, self.colorCount)
-                color = self.paletteColors[r]
+                color = self.colors[r]
 
                 if randint(0, 255) > 254 - self.effectRate:
                     self.lastBrightness[i] = 0
-                    self.thisFrame[i] = color
+                    frame[i*COLORS:i*COLORS+COLORS] = color
 
                 if self.lastBrightness[i] != -1:
                     if self.lastBrightness[i] == self.decayLen:
                         self.lastBrightness[i] = -1
-                        self.thisFrame[i] = ([0.0]*COLORS)
+                        frame[i*COLORS:i*COLORS+COLORS] = self.black
                     else:
                         x = self.lastBrightness[i]
                         self.lastBrightness[i] += 1
-                        self.thisFrame[i] = [self.decayTable[x] * l
-                                                for l in self.thisFrame[i]]
+                        for c in range(i*COLORS, i*COLORS+COLORS):
+                            frame[c] *= self.decayTable[x]
 
-            return self.thisFrame
+            return frame
 
     #Blinking with decay
     class layerStrobe(_layerBase):
@@ -793,16 +2065,18 @@ class ledEffect:
             if len(decayTable) > frameCount:
                 decayTable = decayTable[:frameCount]
             else:
-                decayTable += [0.0] * (frameCount - len(decayTable))
-
-            for c in range(0, len(self.paletteColors)):
-                color = self.paletteColors[c]
-
-                for b in decayTable:
-                    self.thisFrame += [[b * i for i in color] * self.ledCount]
+                decayTable += (0.0,) * (frameCount - len(decayTable))
 
+            self.decayTable = decayTable
+            self.thisFrame = self._frames(
+                len(self.paletteColors) * len(decayTable), self._render)
             self.frameCount = len(self.thisFrame)
 
+        def _render(self, index):
+            c, b = divmod(index, len(self.decayTable))
+            return [self.decayTable[b] * i
+                    for i in self.paletteColors[c]] * self.ledCount
+
     #Lights move sequentially with decay
     class layerComet(_layerBase):
         def __init__(self,  **kwargs):
@@ -834,13 +2108,11 @@ class ledEffect:
             if self.effectRate == 0:
                 self.thisFrame.append(comet[0:self.ledCount])
             else:                           
-                for i in range(len(comet)):
-                    comet.shift(int(self.effectRate+(self.effectRate < 1)), 
-                                self.direction)
-                    self.thisFrame.append(comet[:self.ledCount])
-
-                    for x in range(int((1/self.effectRate)-(self.effectRate <= 1))):
-                        self.thisFrame.append(comet[:self.ledCount])
+                self.thisFrame = self._shiftFrames(comet,
+                    int(self.effectRate+(self.effectRate < 1)),
+                    self.direction, len(comet),
+                    1 + int((1/self.effectRate)-(self.effectRate <= 1)),
+                    first=1)
 
             self.frameCount = len(self.thisFrame)
 
@@ -876,13 +2148,11 @@ class ledEffect:
             if self.effectRate == 0:
                 self.thisFrame.append(chase[0:self.ledCount])
             else:                                                   
-                for _ in range(len(chase)):
-                    chase.shift(int(self.effectRate+(self.effectRate < 1)), 
-                                self.direction)
-                    self.thisFrame.append(chase[0:self.ledCount])
-
-                    for _ in range(int((1/self.effectRate)-(self.effectRate <= 1))):
-                        self.thisFrame.append(chase[0:self.ledCount])
+                self.thisFrame = self._shiftFrames(chase,
+                    int(self.effectRate+(self.effectRate < 1)),
+                    self.direction, len(chase),
+                    1 + int((1/self.effectRate)-(self.effectRate <= 1)),
+                    first=1)
 
             self.frameCount = len(self.thisFrame)
 
@@ -897,28 +2167,29 @@ class ledEffect:
                 raise Exception("effect rate for cylon must be > 0")
 
             # How many frames per sweep animation.
-            frames = int(self.effectRate / self.frameRate)
-
-            direction = True
-
-            for _ in range(len(self.paletteColors) % 2 + 1):
-                for c in range(0, len(self.paletteColors)):
-                    color = self.paletteColors[c]
-
-                    for frame in range(frames):
-                        pct = frame / (frames - 1)
-                        newFrame = []
-
-                        p = int(round((self.ledCount - 2) * pct) if direction else 1 + round(((self.ledCount - 2) * (1 - pct))))
-
-                        for i in range(self.ledCount):
-                            newFrame += color if p == i else [0.0] * COLORS
+            self.frames = int(self.effectRate / self.frameRate)
+            if self.frames == 1:
+                raise Exception("effect rate for cylon must be at least "
+                                "two frames")
+
+            # one sweep per color, back and forth
+            sweeps = len(self.paletteColors) * (len(self.paletteColors) % 2 + 1)
+            self.thisFrame = self._frames(sweeps * self.frames, self._render,
+                                          lazy=True)
+            self.frameCount = len(self.thisFrame)
 
-                        self.thisFrame.append(newFrame)
+        def _render(self, index):
+            sweep, frame = divmod(index, self.frames)
+            color = self.paletteColors[sweep % len(self.paletteColors)]
+            direction = sweep % 2 == 0
 
-                    direction = not direction
+            pct = frame / (self.frames - 1)
+            p = int(round((self.ledCount - 2) * pct) if direction else 1 + round(((self.ledCount - 2) * (1 - pct))))
 
-            self.frameCount = len(self.thisFrame)
+            newFrame = colorArray(COLORS, [0.0] * COLORS * self.ledCount)
+            if 0 <= p < self.ledCount:
+                newFrame[p] = color
+            return newFrame
 
     #Color gradient over all LEDs
     class layerGradient(_layerBase):
@@ -931,20 +2202,25 @@ class ledEffect:
                 gradientLength = self.ledCount
             else:
                 gradientLength=abs(int(1/(self.effectRate * self.frameRate)))
-            gradient = colorArray(COLORS, self._gradient(self.paletteColors, 
+            self.direction = direction
+            self.gradientLength = gradientLength
+            self.gradient = colorArray(COLORS, self._gradient(self.paletteColors, 
                                                   gradientLength,
                                                   toFirst=True))
 
-            for i in range(gradientLength if self.effectRate != 0 else 1):
-                frame = colorArray(COLORS, ([0.0]*COLORS) * self.ledCount)
-                for led in range(self.ledCount):
-                    frame[led] = gradient[ int(i*direction + \
-                        self.effectCutoff * gradientLength * led \
-                        / self.ledCount ) % gradientLength]
-                self.thisFrame.append(frame)
-
+            self.thisFrame = self._frames(
+                gradientLength if self.effectRate != 0 else 1, self._render)
             self.frameCount = len(self.thisFrame)
 
+        def _render(self, i):
+            gradientLength = self.gradientLength
+            frame = colorArray(COLORS, ([0.0]*COLORS) * self.ledCount)
+            for led in range(self.ledCount):
+                frame[led] = self.gradient[ int(i*self.direction + \
+                    self.effectCutoff * gradientLength * led \
+                    / self.ledCount ) % gradientLength]
+            return frame
+
     class layerPattern(_layerBase):
         def __init__(self,  **kwargs):
             super(ledEffect.layerPattern, self).__init__(**kwargs)
@@ -958,10 +2234,10 @@ class ledEffect:
             if int(self.effectRate/self.frameRate) == 0:
                 self.thisFrame.append(frame)
             else:
-                for _ in range(len(self.paletteColors) * (self.ledCount-1)):
-                    for _ in range(int(self.effectRate/self.frameRate)):
-                        self.thisFrame.append(colorArray(COLORS, frame)[:COLORS*self.ledCount])
-                    frame.shift(int(self.effectCutoff))
+                self.thisFrame = self._shiftFrames(frame,
+                    int(self.effectCutoff), True,
+                    len(self.paletteColors) * (self.ledCount-1),
+                    int(self.effectRate/self.frameRate))
                 
             self.frameCount = len(self.thisFrame)
             
@@ -973,11 +2249,10 @@ class ledEffect:
             if len(self.paletteColors) == 1:
                 self.paletteColors += self.paletteColors
 
-            gradient = colorArray(COLORS, self._gradient(self.paletteColors[:-1], 200) +
+            self.gradient = colorArray(COLORS, self._gradient(self.paletteColors[:-1], 200) +
                                     self.paletteColors[-1:])
 
-            for i in range(len(gradient)):
-                self.thisFrame.append(gradient[i] * self.ledCount)
+            self.thisFrame = self._colorFrames()
 
             self.frameCount = len(self.thisFrame)
 
@@ -985,6 +2260,12 @@ class ledEffect:
                 raise self.handler.printer.config_error(
                     "LED Effect '%s' has no heater defined." % (self.handler.name))
 
+        def getInputs(self):
+            return self._heaterInputs()
+
+        def alwaysRenders(self):
+            return False
+
         def nextFrame(self, eventtime):
             heaterTarget  = self.frameHandler.heaterTarget[self.handler.heater]
             heaterCurrent = self.frameHandler.heaterCurrent[self.handler.heater]
@@ -1018,15 +2299,17 @@ class ledEffect:
             super(ledEffect.layerTemperature, self).__init__(**kwargs)
             if len(self.paletteColors) == 1:
                 self.paletteColors = colorArray(COLORS, ([0.0]*COLORS)) + self.paletteColors
-            gradient = colorArray(COLORS, self._gradient(self.paletteColors, 200))
-            for i in range(len(gradient)):
-                self.thisFrame.append(gradient[i] * self.ledCount)
+            self.gradient = colorArray(COLORS, self._gradient(self.paletteColors, 200))
+            self.thisFrame = self._colorFrames()
             self.frameCount = len(self.thisFrame)
 
             if self.handler.heater is None:
                 raise self.handler.printer.config_error(
                     "LED Effect '%s' has no heater defined." % (self.handler.name))
             
+        def getInputs(self):
+            return self._heaterInputs()
+
         def nextFrame(self, eventtime):
             if self.effectCutoff == self.effectRate:
                 s = 200 if self.frameHandler.heaterCurrent[self.handler.heater] >= self.effectRate else 0
@@ -1062,20 +2345,20 @@ class ledEffect:
                                                     int(self.effectCutoff), False))
                 leading.padRight([0.0]*COLORS, self.ledCount)
 
-            gradient = colorArray(COLORS, trailing + self.paletteColors[0] + leading)
-            gradient.shift(len(trailing), 0)
-            frames = [gradient[:self.ledCount]]
+            self.gradient = colorArray(COLORS, trailing + self.paletteColors[0] + leading)
+            self.gradient.shift(len(trailing), 0)
 
-            for i in range(0, self.ledCount):
-                gradient.shift(1,1)
-                frames.append(gradient[:self.ledCount])
+            self.thisFrame = self._frames(101, self._render)
+            self.frameCount = len(self.thisFrame)
 
-            self.thisFrame.append(colorArray(COLORS, [0.0]*COLORS * self.ledCount))
-            for i in range(1, 101):
-                x = int((i / 101.0) * self.ledCount)
-                self.thisFrame.append(frames[x])
+        def _render(self, i):
+            if i == 0:
+                return colorArray(COLORS, [0.0]*COLORS * self.ledCount)
+            x = int((i / 101.0) * self.ledCount)
+            return self._window(self.gradient, self.gradient.offset - x)
 
-            self.frameCount = len(self.thisFrame)
+        def getInputs(self):
+            return self._heaterInputs()
 
         def nextFrame(self, eventtime):
             heaterTarget  = self.frameHandler.heaterTarget[self.handler.heater]
@@ -1104,29 +2387,30 @@ class ledEffect:
 
             leading = colorArray(COLORS, [0.0]*COLORS * self.ledCount)
 
-            gradient = colorArray(COLORS, trailing + self.paletteColors[0] + leading)
-            gradient.shift(len(trailing), 0)
-            frames = [gradient[:self.ledCount]]
-
-            for i in range(0, self.ledCount):
-                gradient.shift(1,1)
-                frames.append(gradient[:self.ledCount])
+            self.gradient = colorArray(COLORS, trailing + self.paletteColors[0] + leading)
+            self.gradient.shift(len(trailing), 0)
 
-            self.thisFrame.append(colorArray(COLORS, [0.0]*COLORS * self.ledCount))
             self.steps = 255
-            for i in range(1, self.steps + 1):
-                x = int((i / float(self.steps + 1)) * self.ledCount)
-                frames2=colorArray(COLORS,[])
+            self.thisFrame = self._frames(self.steps + 1, self._render)
+            self.frameCount = len(self.thisFrame)
 
-                for idx,led in enumerate(frames[x]):
-                    
-                    brightness = min(1.0,max(0.0,len(frames[x]) * (float(i) / float(self.steps + 1)) - int(idx/COLORS)))
-                   
-                    frames2.append(led*brightness)
+        def _render(self, i):
+            if i == 0:
+                return colorArray(COLORS, [0.0]*COLORS * self.ledCount)
+            x = int((i / float(self.steps + 1)) * self.ledCount)
+            frame = self._window(self.gradient, self.gradient.offset - x)
+            frames2=[]
+
+            for idx,led in enumerate(frame):
+                
+                brightness = min(1.0,max(0.0,len(frame) * (float(i) / float(self.steps + 1)) - int(idx/COLORS)))
+               
+                frames2.append(led*brightness)
 
-                self.thisFrame.append(frames2)
+            return colorArray(COLORS, frames2)
 
-            self.frameCount = len(self.thisFrame)
+        def getInputs(self):
+            return self._heaterInputs()
 
         def nextFrame(self, eventtime):
             if self.effectCutoff == self.effectRate:
@@ -1152,10 +2436,12 @@ class ledEffect:
             if len(self.paletteColors) == 1:
                 self.paletteColors = [0.0]*COLORS + self.paletteColors
 
-            gradient   = colorArray(COLORS, self._gradient(self.paletteColors, 101))
+            self.gradient = colorArray(COLORS, self._gradient(self.paletteColors, 101))
+
+            self.thisFrame = self._colorFrames()
 
-            for i in range(len(gradient)):
-                self.thisFrame.append(gradient[i] * self.ledCount)
+        def getInputs(self):
+            return (self.handler.analogValue,)
 
         def nextFrame(self, eventtime):
             v = int(self.handler.analogValue * self.effectRate)
@@ -1192,19 +2478,18 @@ class ledEffect:
                                                     int(self.effectCutoff), False))
                 leading.padRight([0.0]*COLORS, self.ledCount)
 
-            gradient = colorArray(COLORS, trailing + self.paletteColors[0] + leading)
-            gradient.shift(len(trailing)-1, 0)
-            frames = [gradient[:self.ledCount]]
+            self.gradient = colorArray(COLORS, trailing + self.paletteColors[0] + leading)
+            self.gradient.shift(len(trailing)-1, 0)
 
-            for i in range(0, self.ledCount):
-                gradient.shift(1,1)
-                frames.append(gradient[:self.ledCount])
+            self.thisFrame = self._frames(101, self._render)
+            self.frameCount = len(self.thisFrame)
 
-            for i in range(101):
-                x = int((i / 101.0) * self.ledCount)
-                self.thisFrame.append(frames[x])
+        def _render(self, i):
+            x = int((i / 101.0) * self.ledCount)
+            return self._window(self.gradient, self.gradient.offset - x)
 
-            self.frameCount = len(self.thisFrame)
+        def getInputs(self):
+            return tuple(self.frameHandler.stepperPositions)
 
         def nextFrame(self, eventtime):
             if self.handler.stepper == 'x': axis = 0
@@ -1224,10 +2509,12 @@ class ledEffect:
             if len(self.paletteColors) == 1:
                 self.paletteColors = [0.0]*COLORS + self.paletteColors
 
-            gradient   = colorArray(COLORS, self._gradient(self.paletteColors, 101))
+            self.gradient = colorArray(COLORS, self._gradient(self.paletteColors, 101))
 
-            for i in range(len(gradient)):
-                self.thisFrame.append(gradient[i] * self.ledCount)
+            self.thisFrame = self._colorFrames()
+
+        def getInputs(self):
+            return tuple(self.frameHandler.stepperPositions)
 
         def nextFrame(self, eventtime):
             if self.handler.stepper == 'x': axis = 0
@@ -1252,6 +2539,9 @@ class ledEffect:
             self.heatMap    = [0.0] * self.ledCount
             self.gradient   = colorArray(COLORS, self._gradient(self.paletteColors, 
                                                                         102))
+            self.colors     = [tuple(self.gradient[i])
+                               for i in range(len(self.gradient))]
+            self.frameBuffer = [0.0] * COLORS * self.ledCount
             self.frameLen   = len(self.gradient)
             self.heatLen    = len(self.heatMap)
             self.heatSource = int(self.ledCount / 10.0)
@@ -1261,7 +2551,7 @@ class ledEffect:
                 self.heatSource = 1
 
         def nextFrame(self, eventtime):
-            frame = []
+            frame = self.frameBuffer
 
             for h in range(self.heatLen):
                 c = randint(0,self.effectCutoff)
@@ -1280,8 +2570,8 @@ class ledEffect:
                 if self.heatMap[h] > 100:
                     self.heatMap[h] = 100
 
-            for h in self.heatMap:
-                frame += self.gradient[int(h)]
+            for i, h in enumerate(self.heatMap):
+                frame[i*COLORS:i*COLORS+COLORS] = self.colors[int(h)]
 
             return frame
 
@@ -1293,6 +2583,9 @@ class ledEffect:
             self.heatMap    = [0.0] * self.ledCount
             self.gradient   = colorArray(COLORS, self._gradient(self.paletteColors, 
                                                                         102))
+            self.colors     = [tuple(self.gradient[i])
+                               for i in range(len(self.gradient))]
+            self.frameBuffer = [0.0] * COLORS * self.ledCount
             self.frameLen   = len(self.gradient)
             self.heatLen    = len(self.heatMap)
             self.heatSource = int(self.ledCount / 10.0)
@@ -1304,8 +2597,11 @@ class ledEffect:
             if self.heatSource < 1:
                 self.heatSource = 1
 
+        def alwaysRenders(self):
+            return False
+
         def nextFrame(self, eventtime):
-            frame = []
+            frame = self.frameBuffer
             spark = 0
             heaterTarget  = self.frameHandler.heaterTarget[self.handler.heater]
             heaterCurrent = self.frameHandler.heaterCurrent[self.handler.heater]
@@ -1348,8 +2644,8 @@ class ledEffect:
                     if self.heatMap[h] > 100:
                         self.heatMap[h] = 100
 
-                for h in self.heatMap:
-                    frame += self.gradient[int(h)]
+                for i, h in enumerate(self.heatMap):
+                    frame[i*COLORS:i*COLORS+COLORS] = self.colors[int(h)]
 
                 return frame
 
@@ -1381,20 +2677,20 @@ class ledEffect:
                                                     int(self.effectCutoff), False))
                 leading.padRight([0.0]*COLORS, self.ledCount)
 
-            gradient = colorArray(COLORS, trailing + self.paletteColors[0] + leading)
-            gradient.shift(len(trailing), 0)
-            frames = [gradient[:self.ledCount]]
+            self.gradient = colorArray(COLORS, trailing + self.paletteColors[0] + leading)
+            self.gradient.shift(len(trailing), 0)
 
-            for i in range(0, self.ledCount):
-                gradient.shift(1,1)
-                frames.append(gradient[:self.ledCount])
+            self.thisFrame = self._frames(101, self._render)
+            self.frameCount = len(self.thisFrame)
 
-            self.thisFrame.append(colorArray(COLORS, [0.0]*COLORS * self.ledCount))
-            for i in range(1, 101):
-                x = int((i / 101.0) * self.ledCount)
-                self.thisFrame.append(frames[x])
+        def _render(self, i):
+            if i == 0:
+                return colorArray(COLORS, [0.0]*COLORS * self.ledCount)
+            x = int((i / 101.0) * self.ledCount)
+            return self._window(self.gradient, self.gradient.offset - x)
 
-            self.frameCount = len(self.thisFrame)
+        def getInputs(self):
+            return (self.frameHandler.printProgress,)
 
         def nextFrame(self, eventtime):
             p = self.frameHandler.printProgress
@@ -1410,12 +2706,9 @@ class ledEffect:
             gradient = colorArray(COLORS, self._gradient(self.paletteColors, 
                                                 gradientLength))
 
-            for c in range(0, len(self.paletteColors)):
-                color = self.paletteColors[c]
-                self.thisFrame.append(colorArray(COLORS,color*self.ledCount))
+            self._allocFrame()
 
-            self.decayTable = self._decayTable(factor=self.effectRate)
-            self.decayTable.append(0.0)
+            self.decayTable = self._decayTable(factor=self.effectRate) + (0.0,)
             self.decayLen = len(self.decayTable)
             self.counter=self.decayLen-1
             self.coloridx=-1
@@ -1432,7 +2725,8 @@ class ledEffect:
                     self.coloridx = (self.coloridx + 1) % len(self.paletteColors)
                     self.my_flag[endstop] = self.frameHandler.homing_end_flag[endstop]
 
-            frame = [self.decayTable[self.counter] * i for i in self.thisFrame[self.coloridx ]]
+            frame = self._solidFrame([self.decayTable[self.counter] * i
+                                      for i in self.colors[self.coloridx]])
             if self.counter < self.decayLen-1:
                 self.counter += 1 
             
@@ -1444,10 +2738,7 @@ class ledEffect:
             self.coloridx = 0
             self.fadeValue = 0.0
             self.paletteColors = colorArray(COLORS, self.paletteColors)
-
-            for c in range(0, len(self.paletteColors)):
-                color = self.paletteColors[c]
-                self.thisFrame.append(colorArray(COLORS,color*self.ledCount))
+            self._allocFrame()
 
         def nextFrame(self, eventtime):
             if self.handler.button_state > self.last_state:
@@ -1468,7 +2759,8 @@ class ledEffect:
 
             if self.fadeValue < 0: self.fadeValue = 0
             if self.fadeValue > 1.0: self.fadeValue = 1.0
-            return [self.fadeValue * i for i in self.thisFrame[self.coloridx]]
+            return self._solidFrame([self.fadeValue * i
+                                     for i in self.colors[self.coloridx]])
 
     class layerToggleButton(_layerBase):
         def __init__(self,  **kwargs):
@@ -1480,10 +2772,7 @@ class ledEffect:
             self.fadeOutValue = 0.0
             self.active = False
             self.paletteColors = colorArray(COLORS, self.paletteColors)
-
-            for c in range(0, len(self.paletteColors)):
-                color = self.paletteColors[c]
-                self.thisFrame.append(colorArray(COLORS,color*self.ledCount))
+            self._allocFrame()
 
         def nextFrame(self, eventtime):
             if self.handler.button_state > self.last_state:
@@ -1510,10 +2799,10 @@ class ledEffect:
             if self.fadeOutValue < 0: self.fadeOutValue = 0
             if self.fadeOutValue > 1.0: self.fadeOutValue = 1.0
 
-            frameIn = [self.fadeInValue * i for i in self.thisFrame[self.coloridx]]
-            frameOut = [self.fadeOutValue * i for i in self.thisFrame[self.last_coloridx]]
+            colorIn = [self.fadeInValue * i for i in self.colors[self.coloridx]]
+            colorOut = [self.fadeOutValue * i for i in self.colors[self.last_coloridx]]
 
-            return [ i + o for i, o in zip(frameIn,frameOut)]
+            return self._solidFrame([ i + o for i, o in zip(colorIn,colorOut)])
 
     class layerFlashButton(_layerBase):
         def __init__(self,  **kwargs):
@@ -1523,10 +2812,7 @@ class ledEffect:
             self.coloridx = 0
             self.fadeValue = 0.0
             self.paletteColors = colorArray(COLORS, self.paletteColors)
-
-            for c in range(0, len(self.paletteColors)):
-                color = self.paletteColors[c]
-                self.thisFrame.append(colorArray(COLORS,color*self.ledCount))
+            self._allocFrame()
 
         def nextFrame(self, eventtime):
             
@@ -1553,7 +2839,8 @@ class ledEffect:
             if self.fadeValue <= 0: 
                 self.fadeValue = 0
             
-            return [self.fadeValue * i for i in self.thisFrame[self.coloridx]]
+            return self._solidFrame([self.fadeValue * i
+                                     for i in self.colors[self.coloridx]])
 
 def load_config_prefix(config):
     return ledEffect(config)